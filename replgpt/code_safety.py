@@ -0,0 +1,52 @@
+
+import json
+import openai
+
+system_message = (
+    "You are an assistant tasked with deciding whether a Python code snippet, generated by an AI assistant "
+    "embedded in a Python REPL, is safe to execute automatically in the user's session. "
+    "Allow code that only defines things, such as functions, classes, constants or imports. "
+    "Do not allow code that could have side effects, such as reading or writing files, making network "
+    "requests, starting processes, or modifying objects that already exist in the session. "
+    "When in doubt, do not allow the code to be executed."
+    )
+
+response_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "code_safety",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "allow": {"type": "boolean"},
+                },
+            "required": ["allow"],
+            "additionalProperties": False
+            }
+        }
+    }
+
+openai_model="gpt-4o-mini"
+
+async def is_safe_to_execute(code_snippet):
+    """
+    Ask the LLM whether a generated Python code snippet can be executed without side effects.
+
+    :param code_snippet: A string containing the generated Python code.
+    :return: Boolean indicating whether the snippet may be executed automatically.
+    """
+    msgs = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": code_snippet}
+        ]
+
+    response = await openai.ChatCompletion.acreate(
+        model=openai_model,
+        messages=msgs,
+        response_format=response_format,
+    )
+    answer = json.loads(response["choices"][0]["message"]["content"])
+    if not isinstance(answer.get("allow"), bool):
+        raise ValueError("Unexpected response format. Expected a boolean 'allow' attribute.")
+    return answer["allow"]
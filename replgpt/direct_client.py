@@ -0,0 +1,47 @@
+
+import aiohttp
+import openai
+
+from replgpt.json_codec import dumps_json, loads_json
+
+
+class DirectOpenAIClient:
+    """
+    Stream chat completions straight from the OpenAI HTTP API over an aiohttp session, bypassing
+    the request machinery of the openai package. Chunks are yielded in the same shape as the
+    streamed chunks of openai.ChatCompletion so callers can use either interchangeably.
+    """
+    def __init__(self, session):
+        self.session = session  # A long lived aiohttp.ClientSession
+
+    async def stream_chat_completion(self, model, messages):
+        url = f"{openai.api_base}/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {openai.api_key}",
+            "Content-Type": "application/json",
+        }
+        payload = dumps_json({"model": model, "messages": messages, "stream": True})
+
+        try:
+            async with self.session.post(url, data=payload, headers=headers) as resp:
+                if resp.status != 200:
+                    body = await resp.text()
+                    raise openai.error.APIError(
+                        f"Request failed with status {resp.status}: {body}",
+                        http_body=body,
+                        http_status=resp.status,
+                    )
+
+                # The response is a stream of server-sent events, one 'data: {...}' line per chunk
+                async for line in resp.content:
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:"):].strip()
+                    if data == b"[DONE]":
+                        break
+                    chunk = loads_json(data)
+                    if "error" in chunk:
+                        raise openai.error.APIError(chunk["error"].get("message"), json_body=chunk)
+                    yield chunk
+        except aiohttp.ClientError as e:
+            raise openai.error.APIConnectionError(f"Error communicating with OpenAI: {e}") from e
@@ -0,0 +1,20 @@
+import json
+
+try:
+    # Optional, encodes and parses JSON faster than the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads_json(data):
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError so callers can handle either
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj):
+    # Encoded as UTF-8 bytes, ready to be sent or written
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
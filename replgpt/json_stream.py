@@ -0,0 +1,104 @@
+
+import json
+import re
+
+# Characters which end a run of plain characters within a JSON string
+string_special_chars = re.compile(r'["\\]')
+
+
+class JsonStringFieldStreamer:
+    """
+    Incrementally extract the value of a string attribute from a JSON object while the object is
+    being streamed, so it can be displayed before the rest of the object has arrived. Only the
+    first occurrence of the attribute's key is considered, so the attribute should come first.
+    """
+    def __init__(self, field):
+        self.key = json.dumps(field)  # The key as it appears in the JSON, including quotes
+        self.state = "key"  # One of 'key', 'value_start', 'value' or 'done'
+        self.lookback = ""  # Trailing text which may be the start of the key split across chunks
+        self.escape = ""  # Escape sequence within the value which hasn't been completed yet
+
+    @property
+    def found(self):
+        return self.state in ("value", "done")
+
+    def feed(self, text):
+        """
+        Feed the next chunk of the JSON document and return any newly available characters of
+        the attribute's value.
+        """
+        if self.state == "key":
+            text = self.lookback + text
+            start = text.find(self.key)
+            if start == -1:
+                self.lookback = text[-(len(self.key) - 1):]
+                return ""
+            self.state = "value_start"
+            text = text[start + len(self.key):]
+
+        if self.state == "value_start":
+            # Skip the colon and any whitespace up to the value's opening quote
+            stripped = text.lstrip(" \t\r\n:")
+            if not stripped:
+                return ""
+            if stripped[0] != '"':
+                self.state = "done"  # Not a string, nothing to stream
+                return ""
+            self.state = "value"
+            text = stripped[1:]
+
+        if self.state == "value":
+            return self.feed_value(text)
+        return ""
+
+    def feed_value(self, text):
+        out = []
+        i = 0
+        while i < len(text) and self.state == "value":
+            if self.escape:
+                i = self.feed_escape(text, i, out)
+                continue
+
+            match = string_special_chars.search(text, i)
+            end = match.start() if match else len(text)
+            out.append(text[i:end])
+            if match is None:
+                break
+            if text[end] == '"':
+                self.state = "done"
+            else:
+                self.escape = "\\"
+            i = end + 1
+        return "".join(out)
+
+    def feed_escape(self, text, i, out):
+        # Escapes are one character after the backslash, or 'u' and four hex digits. A high
+        # surrogate must be joined with the low surrogate escape which follows it.
+        if len(self.escape) == 6 and self.is_high_surrogate() and text[i] != "\\":
+            out.append(self.decode_escape())
+            return i
+
+        self.escape += text[i]
+        if self.escape[1] != "u":
+            complete = True
+        elif len(self.escape) == 6:
+            complete = not self.is_high_surrogate()
+        elif len(self.escape) == 8 and self.escape[7] != "u":
+            # A lone high surrogate followed by a different escape
+            out.append(json.loads(f'"{self.escape[:6]}"'))
+            self.escape = self.escape[6:]
+            complete = True
+        else:
+            complete = len(self.escape) == 12
+
+        if complete:
+            out.append(self.decode_escape())
+        return i + 1
+
+    def is_high_surrogate(self):
+        return "d800" <= self.escape[2:6].lower() <= "dbff"
+
+    def decode_escape(self):
+        decoded = json.loads(f'"{self.escape}"')
+        self.escape = ""
+        return decoded
@@ -16,7 +16,7 @@ system_message = (
 # consistently fails on some examples provided above.
 openai_model="gpt-4o"
 
-def is_python_with_syntax_error(code_snippet):
+async def is_python_with_syntax_error(code_snippet):
     """
     Evaluate a Python code snippet that is confirmed to generate a syntax error.
 
@@ -34,7 +34,7 @@ def is_python_with_syntax_error(code_snippet):
         ]
     
     # Call OpenAI API to evaluate the code snippet
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model=openai_model,
         messages=msgs,
     )
@@ -48,5 +48,5 @@ def is_python_with_syntax_error(code_snippet):
         raise ValueError("Unexpected response format. Expected 'True' or 'False'.")
         
 
-def is_prompt(code_snippet):
-    return not is_python_with_syntax_error(code_snippet)
+async def is_prompt(code_snippet):
+    return not await is_python_with_syntax_error(code_snippet)
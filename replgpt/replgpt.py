@@ -1,17 +1,29 @@
+import asyncio
 import code
-import openai
-import re
-import readline  # For enhanced REPL history handling
 import os
 import sys
-import io
+import time
+import codecs
 import json
-import readline
-import traceback
-from contextlib import redirect_stdout, redirect_stderr
-from collections import OrderedDict
+import hashlib
+import functools
+from contextlib import contextmanager, redirect_stdout, redirect_stderr, ExitStack
+from collections import OrderedDict, deque
 
-from replgpt import prompt_or_code
+from replgpt import tokens
+from replgpt.json_codec import dumps_json, loads_json
+from replgpt.json_stream import JsonStringFieldStreamer
+
+if sys.stdin is not None and sys.stdin.isatty():
+    import readline  # For enhanced REPL history handling
+else:
+    readline = None  # Scripted input has no use for line editing or history
+
+try:
+    # Optional, caches responses to repeated requests on disk
+    import diskcache
+except ImportError:
+    diskcache = None
 
 
 system_prompt = """
@@ -20,7 +32,8 @@ provided prompts, you will also be supplied with a list of Python code the user
 as the output from the commands. Use both these to inform how you respond to user prompts.
 Additionally, a user may choose to provide you with the contents of files on their system. This
 is likely going to be the contents of Python files they are working with but in theory it could
-be any type of file. Use this to inform your responses well.
+be any type of file. Use this to inform your responses well. Code the user has run is supplied in
+messages starting with [repl-exec], and file contents in messages starting with [file].
 
 User prompts will likely contain requests to generate Python code. Please do so and follow any
 style or conventions the user requests. Barring that, try to match style and conventions to that
@@ -38,12 +51,23 @@ to be generated, do not provide sample input and/or outputs for this function.
 """
 
 json_system_prompt = """
+You are a Python coding assistant embedded within a Python REPL environment. Python code the user has run along with its output is supplied in messages starting with [repl-exec], and the contents of files on their system in messages starting with [file].
+
 Provide the following pieces of information in your response:
-- user_visible_response: The text to be displayed to the user in response to their prompt. This may or may not include Python code.
+- user_visible_response: Always provide this first. The text to be displayed to the user in response to their prompt. This may or may not include Python code.
 - python_code: A piece of Python code that either the user requested directly, or code that would perform an action the user requested to be performed. An example of the former is if the user said 'write a function that...', this attribute should contain a copy of the function requested. Note that that function should still show up in the user visible reponse. An example of code to impliment an action is if the user said 'print the contents of variable x'. In this case, the python_code attribute should contain the code to print this variable. Note that the code in this attribute will not be shown to the user. So if you think it's useful for the user to see the code, you should include it in the user_visible_response attribute.
 - should_execute: Whether or not you believe the user wants the code you generated to be executed. If the user asked you to generate code that defines something, such as a function or class, you can infer it should be executed unless there would be clear side effects. If the user asks for unstructred code, say 'write code that lists the contents of my cwd', use your judgement. However, if the user requested an action to be performed, say 'lists the contents of my cwd', flag this as something that should be executed. However, in the face of ambiguity, you should set should_execute to false.
 """
 
+summary_prompt = """
+You are summarizing the conversation between a user and a Python coding assistant embedded within a
+Python REPL, so the conversation can continue without its earlier messages. Messages starting with
+[repl-exec] are code the user ran along with its output, messages starting with [file] are the
+contents of files the user provided. The conversation may start with a summary of even earlier
+messages, fold it into your summary. Preserve the variables, functions and classes defined, the
+files loaded, and any decisions made or preferences the user expressed. Be concise.
+"""
+
 response_json_schema = {
     "type": "json_schema",
     "json_schema": {
@@ -62,6 +86,17 @@ response_json_schema = {
         }
     }
 
+# Input history, including executed code generated by the Agent, persisted between sessions
+history_file = os.path.expanduser("~/.replgpt_history")
+history_length = 1000  # Most lines kept in the history file
+
+# Where responses are cached when REPLGPT_RESPONSE_CACHE=1 and diskcache is installed, and for how many seconds
+response_cache_dir = os.path.expanduser("~/.cache/replgpt")
+response_cache_expiry = 24 * 60 * 60
+
+# Where each session's conversation is saved so it can be resumed with REPLGPT_SESSION
+session_dir = os.path.expanduser("~/.replgpt")
+
 welcome_banner = """Welcome to ReplGPT, the LLM-Enhanced Python REPL!
 
 This REPL allows you to:
@@ -87,7 +122,8 @@ You also have a few useful commands at your disposal:
 - /file_to_context <file_path> - Read the contents of a local file and load it into the Agent's context window. This is can
 be used to import documentation into the Agent's memory, or give it knowledge of existing code you'd like to work with inside
 of the REPL. Or, if you want to understand a project's dependencies better, run `/file_to_context requirements.txt` and ask
-your agent about the libraries the libraries used.
+your agent about the libraries the libraries used. Files remain in context for the rest of the session, run the command again
+to send the Agent the file's latest contents.
 
 
 - /auto_eval <strategy> - Controls what the REPL will do with code generated by your AI agent. The default strategy of 'always'
@@ -97,41 +133,334 @@ practice this should only allow definitions (functions and classes) but will not
 """
 
 
+@functools.lru_cache(maxsize=256)
+def compile_single(line):
+    # Lines are often re-entered from history, so keep the code objects of recently
+    # compiled lines. A SyntaxError propagates out and is never cached.
+    return compile(line, "<stdin>", "single")
+
+@functools.lru_cache(maxsize=128)
+def compile_snippet(code_snippet):
+    # The Agent often suggests the same code again while a prompt is iterated on
+    return compile(code_snippet, "<string>", "exec")
+
+class BufferPool:
+    """
+    Hand out reusable bytearray buffers so capturing output doesn't allocate new ones for every command.
+    """
+    def __init__(self, max_size=4):
+        self.max_size = max_size  # Upper bound on idle buffers kept around
+        self.buffers = []
+
+    def acquire(self):
+        if self.buffers:
+            return self.buffers.pop()
+        return bytearray()
+
+    def release(self, buffer):
+        if len(self.buffers) < self.max_size:
+            del buffer[:]
+            self.buffers.append(buffer)
+
+_buffer_pool = BufferPool()
+
+class TeeTarget:
+    """
+    A console stream (e.g., sys.stdout or sys.stderr) whose writes are also captured by a DualStream.
+    """
+    # Bytes written without a newline after which the target is flushed anyway
+    flush_threshold = 4096
+
+    def __init__(self, target, owner):
+        self.target = target  # Target file-like object
+        self.binary_target = self.get_binary_target(target)
+        self.owner = owner  # DualStream capturing what's written
+        self.unflushed = 0  # Bytes written to the target since it was last flushed
+
+    @staticmethod
+    def get_binary_target(target):
+        """
+        Return the binary stream underlying a text target when bytes encoded as UTF-8 can be
+        written to it directly, otherwise None.
+        """
+        buffer = getattr(target, "buffer", None)
+        encoding = getattr(target, "encoding", None)
+        if buffer is None or encoding is None or os.linesep != "\n":
+            return None
+        if codecs.lookup(encoding).name != "utf-8":
+            return None
+        target.flush()  # Anything already written as text needs to come out first
+        return buffer
+
+    def write(self, message):
+        self.owner.switch_to(self)
+
+        # Encode once and use the bytes for both the console and the capture buffer
+        encoded = message.encode("utf-8", errors="replace")
+        if self.binary_target is not None:
+            self.binary_target.write(encoded)
+        else:
+            self.target.write(message)  # Write to the console (or target) immediately
+
+        # Line buffered, flushing on every write makes commands which print a lot in small
+        # pieces spend most of their time in write() calls.
+        self.unflushed += len(encoded)
+        if "\n" in message or self.unflushed > self.flush_threshold:
+            self.flush()
+        self.owner.capture_bytes(encoded)
+
+    def flush(self):
+        if self.binary_target is not None:
+            self.binary_target.flush()
+        self.target.flush()
+        self.unflushed = 0
+
 class DualStream:
     """
     Custom stream class to write output to both a target (console) and a buffer (for capturing history).
+
+    When given an error target as well, stderr_proxy writes to it and shares the capture buffer
+    with stdout_proxy, so output and errors are captured in the order they were written.
+
+    Output is captured as UTF-8 and only the first and last char_threshold // 2 bytes are kept, so a
+    runaway command can't grow the buffer without bound. Everything is still written to the target.
     """
-    def __init__(self, target):
-        self.target = target  # Target file-like object (e.g., sys.stdout or sys.stderr)
-        self.buffer = io.StringIO()  # Buffer to capture all output
+    def __init__(self, target, char_threshold, pool=_buffer_pool, error_target=None):
+        self.stdout_proxy = TeeTarget(target, self)
+        self.stderr_proxy = TeeTarget(error_target, self) if error_target is not None else None
+        self.active = self.stdout_proxy  # Proxy written to last
+        self.pool = pool
+        self.half_threshold = char_threshold // 2
+        self.buffer = pool.acquire()  # Buffer to capture the beginning of the output
+        self.tail = pool.acquire()  # Buffer to capture the end of the output, once the first one is full
+        self.tail_size = 0  # Total bytes written after the first buffer filled up
+
+    @contextmanager
+    def capture(self):
+        # Redirect stdout, and stderr when there's an error target, to this stream
+        with ExitStack() as stack:
+            stack.enter_context(redirect_stdout(self.stdout_proxy))
+            if self.stderr_proxy is not None:
+                stack.enter_context(redirect_stderr(self.stderr_proxy))
+            yield self
 
     def write(self, message):
-        self.target.write(message)  # Write to the console (or target) immediately
-        self.target.flush()  # Ensure immediate display
-        self.buffer.write(message)  # Capture to buffer
+        self.stdout_proxy.write(message)
+
+    def switch_to(self, proxy):
+        # A partial line still buffered for one target has to come out before the other
+        # target is written to, or the console shows them out of order.
+        if proxy is not self.active:
+            if self.active.unflushed:
+                self.active.flush()
+            self.active = proxy
+
+    def capture_bytes(self, encoded):
+        if self.buffer is None:  # Code may hold on to the stream after it's released
+            return
+
+        data = memoryview(encoded)
+        room = self.half_threshold - len(self.buffer)
+        if room > 0:
+            self.buffer += data[:room]  # Capture to buffer
+            data = data[room:]
+        if data:
+            # Only the end of the message can survive in the tail. It's allowed to grow to
+            # twice its final size before being trimmed so trimming isn't done on every write.
+            self.tail += data[-self.half_threshold:]
+            self.tail_size += len(data)
+            if len(self.tail) > 2 * self.half_threshold:
+                del self.tail[:-self.half_threshold]
+
+    @property
+    def truncated(self):
+        return self.tail_size > self.half_threshold
 
     def get_value(self):
-        return self.buffer.getvalue()
+        # Join slices of the buffers without copying them first, then decode once
+        if self.truncated:
+            # Cutting at byte offsets may have split a character at the end of the head or the
+            # start of the tail, drop its remaining bytes rather than decode them as U+FFFD.
+            head = memoryview(self.buffer)[:self.char_boundary(self.buffer)]
+            tail = memoryview(self.tail)[-self.half_threshold:]
+            start = 0
+            while start < min(3, len(tail)) and tail[start] & 0xC0 == 0x80:  # Continuation byte
+                start += 1
+            data = b"".join([head, b"\n<output truncated>\n", tail[start:]])
+        else:
+            data = b"".join([self.buffer, self.tail])
+        return data.decode("utf-8", errors="replace")
+
+    @staticmethod
+    def char_boundary(data):
+        """
+        Return the length of data without a multibyte UTF-8 character left incomplete at its end.
+        """
+        for back in range(1, min(4, len(data)) + 1):
+            byte = data[-back]
+            if byte & 0xC0 != 0x80:  # Found the first byte of the last character
+                if byte >= 0xF0:
+                    length = 4
+                elif byte >= 0xE0:
+                    length = 3
+                elif byte >= 0xC0:
+                    length = 2
+                else:
+                    length = 1
+                return len(data) - back if length > back else len(data)
+        return len(data)
+
+    def release(self):
+        # Return the capture buffers to the pool. Later writes still reach the target but are not captured.
+        self.flush()
+        self.pool.release(self.buffer)
+        self.pool.release(self.tail)
+        self.buffer = None
+        self.tail = None
 
     def flush(self):
-        self.target.flush()
+        self.stdout_proxy.flush()
+        if self.stderr_proxy is not None:
+            self.stderr_proxy.flush()
+
+class StreamPrinter:
+    """
+    Coalesce the small text deltas of a streamed LLM response into fewer writes to the console.
+    """
+    def __init__(self, target, max_chunks=16, max_delay=0.03):
+        self.target = target
+        self.max_chunks = max_chunks  # Number of pending deltas that forces a write
+        self.max_delay = max_delay  # Seconds pending text may wait before being written
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.pending.append(text)
+        # Complete lines are written straight away, partial ones once enough text has built up
+        # or it has been waiting for long enough (30ms is roughly one frame at 30 fps).
+        if ("\n" in text or len(self.pending) >= self.max_chunks
+                or time.monotonic() - self.last_flush > self.max_delay):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.target.write("".join(self.pending))
+            self.pending.clear()
+            self.target.flush()
+        self.last_flush = time.monotonic()
+
+    async def flush_periodically(self):
+        # Runs alongside the stream so text isn't held back while waiting on the network.
+        while True:
+            await asyncio.sleep(self.max_delay)
+            if time.monotonic() - self.last_flush >= self.max_delay:
+                self.flush()
+
+class CodeBlockScanner:
+    """
+    Find the first fenced Python block of an LLM response while it is being streamed, so the
+    response doesn't need to be searched again once it's complete.
+    """
+    opening_fence = "```python\n"
+    closing_fence = "```"
+
+    def __init__(self):
+        self.state = "text"  # One of 'text', 'in_code' or 'done'
+        self.lookback = ""  # Trailing text which may be the start of a fence split across deltas
+        self.code_parts = []
+        self.code = None  # Contents of the code block once its closing fence has been seen
+
+    def feed(self, text):
+        if self.state == "done":
+            return
+        text = self.lookback + text
+
+        if self.state == "text":
+            start = text.find(self.opening_fence)
+            if start == -1:
+                self.lookback = text[-(len(self.opening_fence) - 1):]
+                return
+            self.state = "in_code"
+            text = text[start + len(self.opening_fence):]
+
+        end = text.find(self.closing_fence)
+        if end == -1:
+            keep = len(self.closing_fence) - 1
+            self.code_parts.append(text[:-keep])
+            self.lookback = text[-keep:]
+            return
+        self.code_parts.append(text[:end])
+        self.code = "".join(self.code_parts)
+        self.state = "done"
 
 class LLMEnhancedREPL(code.InteractiveConsole):
-    def __init__(self, locals=None):
+    # We don't want to overflow the context window with the output from a runaway
+    # command so we truncate over a certain threshold. This threshold is arbitrarily
+    # decided to be 1% of the total context window for a gpt-4o-mini model, the current
+    # current default model for the repl. This model has a 128,000 token contenxt limit.
+    _RETAINED_TOKEN_THRESHOLD = int(128000 * 0.01)
+
+    # Bytes of a command's output captured while it runs, before it's truncated to the token
+    # threshold. Tokens average roughly 4 chars, so this leaves room for the token count to
+    # decide where output is truncated.
+    _RETAINED_CHAR_THRESHOLD = _RETAINED_TOKEN_THRESHOLD * tokens.chars_per_token * 2
+
+    # Number of recent commands to include in the context of a prompt
+    _HISTORY_SIZE = 50
+
+    # Once the conversation holds more than _SUMMARIZE_THRESHOLD messages after the system message,
+    # or more than _SUMMARIZE_TOKEN_THRESHOLD tokens, everything except the most recent
+    # _MAX_KEPT_MESSAGES is replaced with a summary.
+    _SUMMARIZE_THRESHOLD = 40
+    _SUMMARIZE_TOKEN_THRESHOLD = 64000
+    _MAX_KEPT_MESSAGES = 20
+
+    # Files larger than this are added to the context as their first and last half only, the
+    # same way long command output is truncated.
+    _MAX_FILE_BYTES = 512_000
+
+
+    # Number of safety decisions for the 'infer' auto eval strategy to remember
+    _SAFETY_CACHE_SIZE = 128
+
+    def __init__(self, locals=None, use_direct_api=False, response_cache=None, session_path=None):
         super().__init__(locals=locals)
-        self.history = []  # Track command history with outputs and errors
+        self.history = deque(maxlen=self._HISTORY_SIZE)  # Track recent command history with outputs and errors
         self.in_conversation = False  # Track conversation status with LLM
         self.conversation_history = []  # Preserve full conversation context over time
         self.use_json_mode = False  # Toggle for JSON-based API response mode
         self.file_context = OrderedDict()  # Store file paths and their contents in the order they were added
+        self._unsent_commands = 0  # Number of the most recent commands not yet added to the conversation
+        self._file_cache = {}  # Maps file paths to ((mtime, size), contents) as of the last read
+        self._sent_files = set()  # Paths whose current contents are already in the conversation
+        self._file_messages = {}  # Path -> the conversation message holding the file's contents
+        self._message_tokens = {}  # id() of a conversation message -> (message, token count)
         self.auto_eval_strategy = 'always'
-        
+        self._safety_cache = OrderedDict()  # Digest of a code snippet -> whether it's safe to execute
+
+        # A single event loop and HTTP session are kept for the life of the REPL so
+        # that the async OpenAI calls can reuse pooled connections across prompts.
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self._aiosession_token = None  # Restores openai.aiosession once the session is closed
+        # Stream responses through DirectOpenAIClient instead of the openai package
+        self.use_direct_api = use_direct_api
+        self._direct_client = None
+        # Optional diskcache.Cache of responses keyed by the request which produced them
+        self.response_cache = response_cache
+        # Optional JSON lines file the conversation is saved to, one message per line
+        self.session_path = session_path
+        self._session_log = None
+        self._persisted = 0  # Number of messages already in the session file, None to rewrite it
+
         # Initialize the system message (REPL description) as part of the conversation
         self.system_message = {
             "role": "system",
             "content": self.get_system_prompt()
         }
         self.conversation_history.append(self.system_message)
+        if session_path is not None and os.path.exists(session_path):
+            self.load_conversation(session_path)
 
     def get_system_prompt(self):
         if self.use_json_mode:
@@ -148,148 +477,406 @@ class LLMEnhancedREPL(code.InteractiveConsole):
         }
         # Reset conversation history with updated system prompt
         self.conversation_history = [self.system_message]
+        self._unsent_commands = len(self.history)
+        self._sent_files.clear()
+        self._file_messages.clear()
+        self._persisted = None
+        self.save_conversation()
         print(f"JSON mode {'enabled' if self.use_json_mode else 'disabled'}.")
 
-    def push(self, line):
-        # Allow special command to print conversation history or toggle JSON mode
-        if line.strip() == "/print_history":
-            self.print_conversation_history()
-            return
-        elif line.strip() == "/toggle_json_mode":
-            self.toggle_json_mode()
-            return
-        elif line.strip() == "/help":
-            print(help_text)
-            return
-        elif line.startswith("/debug"):
-            openai.log = "debug"
-            return
-        elif line.startswith("/file_to_context"):
-            _, file_path = line.split(maxsplit=1)
+    def command_print_history(self, arg):
+        self.print_conversation_history()
+
+    def command_toggle_json_mode(self, arg):
+        self.toggle_json_mode()
+
+    def command_help(self, arg):
+        print(help_text)
+
+    def command_debug(self, arg):
+        import openai
+        openai.log = "debug"
+
+    def command_file_to_context(self, file_path):
+        if not file_path:
+            print("Error: No file path given. Usage: /file_to_context <file_path>")
+        else:
             self.add_file_to_context(file_path)
-            return
-        elif line.startswith("/auto_eval"):
-            _, strategy = line.split(maxsplit=1)
-            valid_strategies = ['always', 'never', 'infer']
-            if strategy not in valid_strategies:
-                print(f"Error: Invalid strategy '{strategy}'. Try one of the following: {', '.join(valid_strategies)}, or run /help for more info.")
-            else:
-                self.auto_eval_strategy = strategy
-            return
 
-        # Track command and its output/errors
-        output_stream = DualStream(sys.stdout)  # For capturing and displaying stdout
-        error_stream = DualStream(sys.stderr)  # For capturing and displaying stderr
+    def command_auto_eval(self, strategy):
+        valid_strategies = ['always', 'never', 'infer']
+        if strategy not in valid_strategies:
+            print(f"Error: Invalid strategy '{strategy}'. Try one of the following: {', '.join(valid_strategies)}, or run /help for more info.")
+        else:
+            self.auto_eval_strategy = strategy
+
+    # Special commands which control the REPL, mapped to the method handling them. Each
+    # method is passed the remainder of the line as its argument.
+    _COMMANDS = {
+        "/print_history": command_print_history,
+        "/toggle_json_mode": command_toggle_json_mode,
+        "/help": command_help,
+        "/debug": command_debug,
+        "/file_to_context": command_file_to_context,
+        "/auto_eval": command_auto_eval,
+    }
 
-        # Redirect stdout and stderr to capture both streams
-        with redirect_stdout(output_stream), redirect_stderr(error_stream):
+    def push(self, line):
+        # Dispatch special commands, anything else is treated as code or a prompt
+        stripped = line.strip()
+        if stripped[:1] == "/":
+            parts = stripped.split(maxsplit=1)
+            name = parts[0]
+            arg = parts[1] if len(parts) > 1 else ""
+            command = self._COMMANDS.get(name)
+            if command is not None:
+                command(self, arg)
+                return
+
+        # Track command and its output/errors, capturing both streams together in the order written
+        output_stream = DualStream(sys.stdout, self._RETAINED_CHAR_THRESHOLD, error_target=sys.stderr)
+
+        is_prompt = False
+        with output_stream.capture():
             try:
-                compiled_code = compile(line, "<stdin>", "single")
+                compiled_code = compile_single(line)
                 exec(compiled_code, self.locals)
             except SyntaxError as e:
-                if prompt_or_code.is_prompt(line):
+                from replgpt import prompt_or_code
+                self.open_session()
+                if self.run(prompt_or_code.is_prompt(line)):
+                    is_prompt = True
                     self.handle_prompt(line)
                 else:
                     print(f"SyntaxError: {e}")
             except Exception as e:
                 # Print the exception exactly as it would normally be displayed
+                import traceback
                 traceback.print_exc()
 
         # Capture output and errors for history
-        raw_output = output_stream.get_value()
-        raw_errors = error_stream.get_value()
+        try:
+            output = self.retained_output(output_stream)
+        finally:
+            output_stream.release()
+
+        # Prompts and their responses are already part of the conversation
+        if is_prompt:
+            return
 
-        char_thesh = self.retained_char_threshold()
-        output = self.limit_command_output(raw_output, char_thesh)
-        errors = self.limit_command_output(raw_errors, char_thesh)
-        
         # Store command, output, and errors in history for context    
         command_entry = f">>> {line}\n{output}"
-        if errors.strip():
-            command_entry += f"\n{errors}"
         self.history.append(command_entry)
+        self._unsent_commands = min(self._unsent_commands + 1, len(self.history))
+
+    def retained_output(self, stream):
+        return self.limit_command_output(stream.get_value(), self._RETAINED_TOKEN_THRESHOLD)
 
-    def limit_command_output(self, output, char_threshold):
+    def limit_command_output(self, output, token_threshold):
         """
         Given a potentially large amount of output from a Python command,
         thoughtfully limit the size of the output before retaining it for
         inclusion in our conversation. If the output is less that the
-        character threshold, this function is a no-op.
+        token threshold, this function is a no-op.
         """
-        output = output.strip()
-        if len(output) < char_threshold:
-            return output
-        else:
-            half_threshold = char_threshold // 2
-            beginning = output[:half_threshold]
-            end = output[-half_threshold:]
-            return f"{beginning}\n<output truncated>\n{end}"
-
-    def retained_char_threshold(self):
-        # We don't want to overflow the context window with the output from a runaway
-        # command so we truncate over a certain threshold. This threshold is arbitrarily
-        # decided to be 1% of the total context window for a gpt-4o-mini model, the current
-        # current default model for the repl. This model has a 128,000 token contenxt limit,
-        # and OpenAI states that a token is roughly 4 chars. So we calculate our threshold
-        # here, then use that to limit the command output retained.
-        token_threshold = 128000 * 0.01 
-        char_threshold = token_threshold * 4
-        return int(char_threshold)
-    
+        return tokens.truncate_middle(output.strip(), token_threshold)
+
     def add_file_to_context(self, file_path):
         try:
-            with open(file_path, "r") as file:
-                self.file_context[file_path] = file.read()
-                print(f"File '{file_path}' added to context.")
+            self.file_context[file_path] = self.read_file(file_path)
+            self._sent_files.discard(file_path)  # (Re)send the contents with the next prompt
+            print(f"File '{file_path}' added to context ({tokens.token_len(self.file_context[file_path])} tokens).")
         except Exception as e:
             print(f"Error reading file '{file_path}': {e}")
 
+    def read_file(self, file_path):
+        # Files are frequently re-added while iterating on them, so only go back to disk
+        # when the file has been modified since we last read it.
+        st = os.stat(file_path)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._file_cache.get(file_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        # Read raw bytes and decode once rather than going through a locale-aware text wrapper
+        with open(file_path, "rb") as file:
+            if st.st_size <= self._MAX_FILE_BYTES:
+                contents = file.read().decode("utf-8", errors="replace")
+            else:
+                half = self._MAX_FILE_BYTES // 2
+                beginning = file.read(half)
+                file.seek(-half, os.SEEK_END)
+                end = file.read()
+                contents = b"\n<file truncated>\n".join([beginning, end]).decode("utf-8", errors="replace")
+        self._file_cache[file_path] = (key, contents)
+        return contents
+
+    def open_session(self):
+        # Every request, including deciding whether a line is a prompt, shares one pooled
+        # session so connections are kept alive between them.
+        if self._session is None:
+            # openai and aiohttp take longer to import than everything else together, so they're
+            # only imported by the methods which need them. That keeps starting the REPL fast.
+            import openai
+            from replgpt.direct_client import DirectOpenAIClient
+            self._session = self.run(self._open_session())
+            # The session needs to be set in this context, not inside a task, so that
+            # every task created by the loop afterwards inherits it.
+            self._aiosession_token = openai.aiosession.set(self._session)
+            self._direct_client = DirectOpenAIClient(self._session)
+
     def handle_prompt(self, user_input):
-        if self.use_json_mode:
-            self.handle_json_prompt(user_input)
-        else:
-            self.handle_standard_prompt(user_input)
-
-    def build_user_message(self, user_input):
-        # Build user message with command history and file contents
-        message_content = (
-            "The following are the last entered Python commands with their outputs and errors:\n\n" +
-            "\n".join(self.history)
-        )
-
-        # Include file contents if any files are loaded
-        if self.file_context:
-            message_content += "\n\nIncluding file contents:\n"
-            for file_path, file_contents in self.file_context.items():
-                message_content += f"\nFile: {file_path}\n{file_contents}\n"
-
-        # Append user input to the message content
-        message_content += f"\n\nUser input: {user_input}"
-
-        # Create and return the user message structure
-        return {
-            "role": "user",
-            "content": message_content
-        }
+        self.open_session()
+        self.run(self._handle_prompt_async(user_input))
+
+    def run(self, coro):
+        # Run a coroutine on the REPL's loop. If Ctrl-C interrupts it the task has to be cancelled
+        # and waited for here, otherwise it would carry on the next time the loop runs.
+        task = self._loop.create_task(coro)
+        try:
+            return self._loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            self._loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            raise
+
+    async def _open_session(self):
+        # Prompts are often minutes apart, keep idle connections open well beyond aiohttp's
+        # default of 15 seconds so later prompts don't have to redo the TCP and TLS handshakes.
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=300)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def _handle_prompt_async(self, user_input):
+        try:
+            if self.use_json_mode:
+                await self.handle_json_prompt(user_input)
+            else:
+                await self.handle_standard_prompt(user_input)
+        finally:
+            self.save_conversation()
+
+    def load_conversation(self, path):
+        """
+        Resume the conversation saved in a session file, including the files added to it. A file
+        which can't be resumed is left alone and the conversation isn't saved.
+        """
+        try:
+            with open(path, "rb") as file:
+                records = [loads_json(line) for line in file if line.strip()]
+            messages = [record["message"] for record in records]
+            if not messages or messages[0]["role"] != "system":
+                raise ValueError("it doesn't start with a system message")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Error reading session file '{path}', this session won't be saved: {e}")
+            self.session_path = None
+            return
+
+        self.system_message = messages[0]
+        self.use_json_mode = self.system_message["content"] == json_system_prompt
+        self.conversation_history = messages
+        self._persisted = len(messages)
+        for record in records:
+            file_path = record.get("file")
+            if file_path is not None:
+                message = record["message"]
+                self.file_context[file_path] = message["content"][len(f"[file] {file_path}\n"):]
+                self._sent_files.add(file_path)
+                self._file_messages[file_path] = message
+        print(f"Resumed {len(messages) - 1} messages from '{path}'.")
+
+    def save_conversation(self):
+        # Messages are only ever appended between summaries, so normally just the new ones
+        # are written. The file is rewritten when the conversation is replaced. Each line holds
+        # a message, and the path of the file when the message holds a file's contents.
+        if self.session_path is None:
+            return
+        try:
+            if self._session_log is None:
+                # The conversation includes the contents of files added to it, keep it private
+                os.makedirs(os.path.dirname(self.session_path) or ".", mode=0o700, exist_ok=True)
+                fd = os.open(self.session_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                self._session_log = os.fdopen(fd, "ab", buffering=0)
+            if self._persisted is None:
+                self._session_log.truncate(0)  # Appends still go to the new end of the file
+                self._persisted = 0
+            new_messages = self.conversation_history[self._persisted:]
+            if new_messages:
+                file_paths = {id(message): path for path, message in self._file_messages.items()}
+                records = []
+                for message in new_messages:
+                    record = {"message": message}
+                    if id(message) in file_paths:
+                        record["file"] = file_paths[id(message)]
+                    records.append(dumps_json(record) + b"\n")
+                self._session_log.write(b"".join(records))
+            self._persisted = len(self.conversation_history)
+        except OSError as e:
+            print(f"Error writing session file '{self.session_path}': {e}")
+
+    def close(self):
+        """
+        Release the HTTP session and event loop used for talking to OpenAI, the response cache and
+        the session file.
+        """
+        if self._session is not None:
+            # Stop openai using the session before it's closed, later requests made in this
+            # process would otherwise fail with "Session is closed".
+            import openai
+            openai.aiosession.reset(self._aiosession_token)
+            self._aiosession_token = None
+            self._loop.run_until_complete(self._session.close())
+            self._session = None
+        self._loop.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        if self._session_log is not None:
+            self._session_log.close()
+            self._session_log = None
 
-    def handle_standard_prompt(self, user_input):
-        user_message = self.build_user_message(user_input)
-        self.conversation_history.append(user_message)
+    def build_user_messages(self, user_input):
+        """
+        Build the messages to add to the conversation for a prompt. Commands run and files added
+        since the last prompt each become their own message ahead of the prompt itself. Messages
+        are never changed once they are part of the conversation, so every request shares the
+        previous request's messages as a prefix which OpenAI's prompt caching can reuse.
+        """
+        messages = []
+        if self._unsent_commands:
+            recent_commands = list(self.history)[-self._unsent_commands:]
+            messages.extend(
+                {"role": "user", "content": f"[repl-exec]\n{command_entry}"}
+                for command_entry in recent_commands
+            )
+            self._unsent_commands = 0
 
+        for file_path, file_contents in self.file_context.items():
+            if file_path not in self._sent_files:
+                message = {"role": "user", "content": f"[file] {file_path}\n{file_contents}"}
+                messages.append(message)
+                self._sent_files.add(file_path)
+                self._file_messages[file_path] = message
+
+        messages.append({"role": "user", "content": user_input})
+        return messages
+
+    async def summarize_conversation(self):
+        """
+        Keep the conversation from growing without bound by replacing its older messages with an
+        LLM generated summary. A previous summary is part of the older messages, so it gets folded
+        into the new one.
+        """
+        import openai
+        over_count = len(self.conversation_history) - 1 > self._SUMMARIZE_THRESHOLD
+        if not over_count and self.conversation_tokens() <= self._SUMMARIZE_TOKEN_THRESHOLD:
+            return
+
+        older = self.conversation_history[1:-self._MAX_KEPT_MESSAGES]
+        if not older:
+            return
+        # When only the token budget is exceeded, wait until the older messages hold a good share
+        # of the tokens. Otherwise, when the kept messages alone are over budget (e.g. a large file
+        # was just added), every prompt would make a request to summarize one or two messages.
+        if not over_count:
+            older_tokens = sum(self._message_tokens[id(msg)][1] for msg in older)
+            if older_tokens < self._SUMMARIZE_TOKEN_THRESHOLD // 2:
+                return
+        kept = self.conversation_history[-self._MAX_KEPT_MESSAGES:]
+        transcript = "\n\n".join(f"{msg['role'].capitalize()}: {msg['content']}" for msg in older)
         try:
-            # Send the conversation history to the OpenAI API for context continuity
-            response = openai.ChatCompletion.create(
+            response = await openai.ChatCompletion.acreate(
                 model="gpt-4o-mini",
-                messages=self.conversation_history,
-                stream=True  # Stream response
+                messages=[
+                    {"role": "system", "content": summary_prompt},
+                    {"role": "user", "content": transcript},
+                ],
             )
+        except openai.error.OpenAIError as e:
+            print(f"Unable to summarize conversation history: {e}")
+            return
+        summary = response["choices"][0]["message"]["content"]
+
+        summary_message = {"role": "system", "content": f"Conversation summary so far:\n{summary}"}
+        self.conversation_history = [self.system_message, summary_message] + kept
+        self._persisted = None
+
+        # Files whose contents were summarized away are sent again with the next prompt
+        older_ids = {id(msg) for msg in older}
+        for file_path, message in list(self._file_messages.items()):
+            if id(message) in older_ids:
+                self._sent_files.discard(file_path)
+                del self._file_messages[file_path]
+
+    def conversation_tokens(self):
+        # Messages are never modified once they are in the conversation, so each one's token
+        # count is computed once and looked up by identity afterwards. The message is stored
+        # alongside its count so a recycled id() can't match a different message.
+        counts = {}
+        total = 0
+        for message in self.conversation_history:
+            cached = self._message_tokens.get(id(message))
+            if cached is not None and cached[0] is message:
+                count = cached[1]
+            else:
+                count = tokens.token_len(message["content"])
+            counts[id(message)] = (message, count)
+            total += count
+        # Rebuilding the mapping each time drops messages which left the conversation
+        self._message_tokens = counts
+        return total
+
+    async def handle_standard_prompt(self, user_input):
+        import openai
+        # Summarize first so files whose messages get summarized away are sent again with this prompt
+        await self.summarize_conversation()
+        self.conversation_history.extend(self.build_user_messages(user_input))
+
+        cache_key = self.response_cache_key()
+        cached_response = self.response_cache.get(cache_key) if cache_key else None
+
+        try:
+            # Send the conversation history to the OpenAI API for context continuity, unless
+            # this exact request has been answered before.
+            if cached_response is not None:
+                deltas = self.replay_response(cached_response)
+            elif self.use_direct_api:
+                deltas = self.response_deltas(self._direct_client.stream_chat_completion(
+                    model="gpt-4o-mini",
+                    messages=self.conversation_history,
+                ))
+            else:
+                deltas = self.response_deltas(await openai.ChatCompletion.acreate(
+                    model="gpt-4o-mini",
+                    messages=self.conversation_history,
+                    stream=True  # Stream response
+                ))
 
             # Process streamed response
-            full_response = ""
-            for chunk in response:
-                text = chunk["choices"][0]["delta"].get("content", "")
-                print(text, end="", flush=True)
-                full_response += text
+            printer = StreamPrinter(sys.stdout)
+            flusher = asyncio.ensure_future(printer.flush_periodically())
+            scanner = CodeBlockScanner()
+            safety_check = None
+            parts = []
+            try:
+                async for text in deltas:
+                    printer.write(text)
+                    scanner.feed(text)
+                    parts.append(text)
+
+                    # Start checking the code as soon as its block is closed, overlapping the
+                    # check with the remainder of the stream.
+                    if safety_check is None and scanner.code and 'infer' == self.auto_eval_strategy:
+                        safety_check = asyncio.ensure_future(self.is_safe_to_execute(scanner.code))
+            except BaseException:
+                if safety_check is not None:
+                    safety_check.cancel()
+                raise
+            finally:
+                flusher.cancel()
+                printer.flush()
+            full_response = "".join(parts)
+            if cache_key and cached_response is None:
+                self.response_cache.set(cache_key, full_response, expire=response_cache_expiry)
 
             # While we have the full output, check if new need to print a \n char or not. If
             # we don't do this we get the '>>>' input prompt on the same line as the
@@ -302,33 +889,67 @@ class LLMEnhancedREPL(code.InteractiveConsole):
             self.conversation_history.append(assistant_message)
 
             # Check if there's Python code in the response and prompt user to execute it
-            code_snippet = self.extract_code(full_response)
+            code_snippet = scanner.code
             if code_snippet and ('always' == self.auto_eval_strategy):
                 self.execute_code(code_snippet)
+            elif safety_check is not None:
+                try:
+                    if await safety_check:
+                        self.execute_code(code_snippet)
+                    else:
+                        print("Generated code was not executed as it may have side effects.")
+                except ValueError as e:
+                    print(f"Unable to determine if generated code is safe to execute: {e}")
 
         except openai.error.OpenAIError as e:
             print(f"Error communicating with OpenAI API: {e}")
             print("Returning to REPL prompt.")
 
-        # Clear command history after each prompt submission
-        self.history.clear()
-        self.file_context.clear()
+    async def handle_json_prompt(self, user_input):
+        import openai
+        # Summarize first so files whose messages get summarized away are sent again with this prompt
+        await self.summarize_conversation()
+        self.conversation_history.extend(self.build_user_messages(user_input))
 
-    def handle_json_prompt(self, user_input):
-        user_message = self.build_user_message(user_input)
-        self.conversation_history.append(user_message)
+        cache_key = self.response_cache_key()
+        cached_response = self.response_cache.get(cache_key) if cache_key else None
 
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=self.conversation_history,
-                response_format=response_json_schema,
-                )
-            json_response = response.choices[0].message.content
-            response = json.loads(json_response)
+            if cached_response is not None:
+                deltas = self.replay_response(cached_response)
+            else:
+                deltas = self.response_deltas(await openai.ChatCompletion.acreate(
+                    model="gpt-4o-mini",
+                    messages=self.conversation_history,
+                    response_format=response_json_schema,
+                    stream=True  # Stream response
+                    ))
+
+            # Display text to the user as it streams in, the rest of the response is only
+            # needed once it's complete.
+            printer = StreamPrinter(sys.stdout)
+            flusher = asyncio.ensure_future(printer.flush_periodically())
+            streamer = JsonStringFieldStreamer("user_visible_response")
+            parts = []
+            try:
+                async for text in deltas:
+                    parts.append(text)
+                    visible_text = streamer.feed(text)
+                    if visible_text:
+                        printer.write(visible_text)
+            finally:
+                flusher.cancel()
+                printer.flush()
+            json_response = "".join(parts)
 
-            # Display text to the user
-            print(response.get("user_visible_response", ""))
+            response = loads_json(json_response)
+            if cache_key and cached_response is None:
+                self.response_cache.set(cache_key, json_response, expire=response_cache_expiry)
+
+            if streamer.found:
+                print("")
+            else:
+                print(response.get("user_visible_response", ""))
 
             # Execute code if we got code and `should_execute` is True
             if response.get("should_execute") and response.get("python_code"):
@@ -344,21 +965,49 @@ class LLMEnhancedREPL(code.InteractiveConsole):
             print(f"Error communicating with OpenAI API: {e}")
             print("Returning to REPL prompt.")
 
-        # Clear command history after each prompt submission
-        self.history.clear()
-        self.file_context.clear()
+    def response_cache_key(self):
+        """
+        Key identifying the request about to be sent, or None when responses aren't being cached.
+        """
+        if self.response_cache is None:
+            return None
+        request = json.dumps([self.use_json_mode, self.conversation_history], sort_keys=True)
+        return hashlib.blake2b(request.encode("utf-8"), digest_size=16).hexdigest()
+
+    async def response_deltas(self, response):
+        # Text of each chunk of a streamed chat completion
+        async for chunk in response:
+            yield chunk["choices"][0]["delta"].get("content") or ""
+
+    async def replay_response(self, text):
+        # Stands in for a streamed response with a cached one
+        yield text
 
-    def extract_code(self, text):
-        match = re.search(r"```python\n(.*?)```", text, re.DOTALL)
-        return match.group(1) if match else None
+    async def is_safe_to_execute(self, code_snippet):
+        # Iterating on a prompt often produces the same snippet again, so remember recent decisions
+        key = hashlib.blake2b(code_snippet.encode("utf-8"), digest_size=16).hexdigest()
+        if key in self._safety_cache:
+            self._safety_cache.move_to_end(key)
+            return self._safety_cache[key]
+
+        from replgpt import code_safety
+        allowed = await code_safety.is_safe_to_execute(code_snippet)
+        self._safety_cache[key] = allowed
+        if len(self._safety_cache) > self._SAFETY_CACHE_SIZE:
+            self._safety_cache.popitem(last=False)
+        return allowed
 
     def execute_code(self, code_snippet):
         try:
-            exec(code_snippet, self.locals)
+            exec(compile_snippet(code_snippet), self.locals)
             print("Code executed successfully.")
 
-            # Add code to the input history, as if the user typed it themselves
-            readline.add_history(code_snippet)
+            # Add code to the input history, as if the user typed it themselves. Each line is
+            # added separately so they can be recalled individually.
+            if readline is not None:
+                for line in code_snippet.splitlines():
+                    if line.strip():
+                        readline.add_history(line)
         except Exception as e:
             print(f"Error executing code: {e}")
         
@@ -369,6 +1018,21 @@ class LLMEnhancedREPL(code.InteractiveConsole):
             print("\nExiting REPL.")
             raise SystemExit
 
+    def load_history(self, path):
+        try:
+            readline.read_history_file(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error reading history file '{path}': {e}")
+
+    def save_history(self, path):
+        # Written once when the REPL exits rather than as commands are entered
+        try:
+            readline.write_history_file(path)
+        except OSError as e:
+            print(f"Error writing history file '{path}': {e}")
+
     def print_conversation_history(self):
         print("\nConversation History:")
         for msg in self.conversation_history:
@@ -377,18 +1041,38 @@ class LLMEnhancedREPL(code.InteractiveConsole):
             print(f"{role.capitalize()}: {content}\n")
 
 def main():
-    # Set OpenAI API key
+    # openai reads the API key from the environment once it's imported
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
             print("Error: The OPENAI_API_KEY environment variable is not set.")
             print("Please set the API key to use the LLM-enhanced REPL.")
             sys.exit(1)
     
-    openai.api_key = api_key
-    
     # Start the REPL
-    repl = LLMEnhancedREPL()
-    repl.interact(banner = welcome_banner)
+    response_cache = None
+    if os.getenv("REPLGPT_RESPONSE_CACHE") == "1":
+        if diskcache is not None:
+            response_cache = diskcache.Cache(response_cache_dir)
+        else:
+            print("Warning: REPLGPT_RESPONSE_CACHE is set but diskcache isn't installed, responses won't be cached.")
+    repl = LLMEnhancedREPL(
+        use_direct_api=os.getenv("REPLGPT_DIRECT_API") == "1",
+        response_cache=response_cache,
+        session_path=os.getenv("REPLGPT_SESSION") or os.path.join(session_dir, f"session-{os.getpid()}.jsonl"),
+    )
+    # readline is only imported for interactive sessions, scripted input neither needs the
+    # user's history nor should end up in it
+    if readline is not None:
+        readline.set_history_length(history_length)
+        repl.load_history(history_file)
+    try:
+        repl.interact(banner = welcome_banner)
+    finally:
+        if readline is not None:
+            repl.save_history(history_file)
+        if repl.session_path is not None and os.path.exists(repl.session_path):
+            print(f"Conversation saved, set REPLGPT_SESSION={repl.session_path} to resume it.")
+        repl.close()
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,54 @@
+
+import functools
+
+# Model whose tokenizer is used for counting, the default model for the repl
+openai_model = "gpt-4o-mini"
+
+# OpenAI states that a token is roughly 4 chars, used to estimate when there's no tokenizer
+chars_per_token = 4
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    """
+    Return the tiktoken encoding for the repl's model, or None if it isn't available. Loading an
+    encoding the first time may require downloading it, so any failure falls back to estimating.
+    """
+    try:
+        # Optional, gives exact token counts rather than an estimate. Imported here rather than
+        # with the module as it's slow to import and only needed once something is counted.
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(openai_model)
+    except Exception:
+        return None
+
+@functools.lru_cache(maxsize=1024)
+def token_len(text):
+    """
+    Count the tokens in a piece of text. Results are cached by the text itself as the same command
+    output and file contents get counted repeatedly.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text) // chars_per_token)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_middle(text, max_tokens):
+    """
+    Limit text to roughly max_tokens by keeping its first and last max_tokens // 2 tokens. Text
+    with fewer than max_tokens tokens is returned unchanged.
+    """
+    if token_len(text) < max_tokens:
+        return text
+
+    half_tokens = max_tokens // 2
+    encoding = get_encoding()
+    if encoding is None:
+        half_chars = half_tokens * chars_per_token
+        beginning, end = text[:half_chars], text[-half_chars:]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        beginning, end = encoding.decode(tokens[:half_tokens]), encoding.decode(tokens[-half_tokens:])
+    return f"{beginning}\n<output truncated>\n{end}"
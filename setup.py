@@ -17,6 +17,11 @@ with open("requirements.txt") as f:
                 include_package_data=True,
                 python_requires=">=3.6",
                 install_requires=requirements,  # Load dependencies from requirements.txt
+                extras_require={
+                        "speedups": ["orjson"],
+                        "tokenizer": ["tiktoken"],
+                        "cache": ["diskcache"],
+                    },
                 entry_points={
                 "console_scripts": [
                                 "replgpt=replgpt.replgpt:main",
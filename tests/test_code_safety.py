@@ -0,0 +1,31 @@
+import asyncio
+import unittest
+
+
+from replgpt.code_safety import is_safe_to_execute
+
+class TestCodeSafety(unittest.TestCase):
+    # Integration tests which hit the OpenAI API.
+
+    def test_definitions_are_safe(self):
+        """Test snippets which only define things"""
+        safe_snippets = [
+            "def add(a, b):\n    return a + b\n",
+            "class Point:\n    def __init__(self, x, y):\n        self.x = x\n        self.y = y\n",
+        ]
+        for snippet in safe_snippets:
+            with self.subTest(snippet=snippet):
+                self.assertTrue(asyncio.run(is_safe_to_execute(snippet)))
+
+    def test_side_effects_are_not_safe(self):
+        """Test snippets which modify the user's system"""
+        unsafe_snippets = [
+            "import os\nos.remove('data.csv')\n",
+            "import shutil\nshutil.rmtree('/tmp/project')\n",
+        ]
+        for snippet in unsafe_snippets:
+            with self.subTest(snippet=snippet):
+                self.assertFalse(asyncio.run(is_safe_to_execute(snippet)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import unittest
+
+import openai
+from aiohttp import ClientSession, web
+
+from replgpt.direct_client import DirectOpenAIClient
+
+def sse(*events):
+    return "".join(f"data: {event}\n\n" for event in events).encode("utf-8")
+
+class TestDirectOpenAIClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.status = 200
+        self.body = b""
+
+        async def chat_completions(request):
+            self.requests.append(await request.json())
+            return web.Response(status=self.status, body=self.body, content_type="text/event-stream")
+
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", chat_completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        self.api_base = openai.api_base
+        openai.api_base = f"http://127.0.0.1:{port}/v1"
+        self.session = ClientSession()
+        self.client = DirectOpenAIClient(self.session)
+
+    async def asyncTearDown(self):
+        openai.api_base = self.api_base
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def collect(self):
+        messages = [{"role": "user", "content": "hi"}]
+        return [chunk async for chunk in self.client.stream_chat_completion("gpt-4o-mini", messages)]
+
+    async def test_streams_chunks(self):
+        self.body = sse(
+            json.dumps({"choices": [{"delta": {"role": "assistant", "content": ""}}]}),
+            json.dumps({"choices": [{"delta": {"content": "Hello"}}]}),
+            json.dumps({"choices": [{"delta": {}}]}),
+            "[DONE]",
+        )
+        chunks = await self.collect()
+        text = "".join(chunk["choices"][0]["delta"].get("content") or "" for chunk in chunks)
+        self.assertEqual(text, "Hello")
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(self.requests[0]["model"], "gpt-4o-mini")
+        self.assertTrue(self.requests[0]["stream"])
+
+    async def test_error_status(self):
+        self.status = 401
+        self.body = b'{"error": {"message": "bad key"}}'
+        with self.assertRaises(openai.error.APIError):
+            await self.collect()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import json
+import unittest
+
+from replgpt.json_stream import JsonStringFieldStreamer
+
+class TestJsonStringFieldStreamer(unittest.TestCase):
+
+    def stream(self, document, chunk_size):
+        streamer = JsonStringFieldStreamer("user_visible_response")
+        chunks = [document[i:i + chunk_size] for i in range(0, len(document), chunk_size)]
+        return "".join(streamer.feed(chunk) for chunk in chunks), streamer
+
+    def test_streams_value(self):
+        value = 'Use "print":\n\tprint(x) \\ done é \U0001F600'
+        for ensure_ascii in (True, False):
+            document = json.dumps({"user_visible_response": value, "python_code": "print(x)"}, ensure_ascii=ensure_ascii)
+            for chunk_size in range(1, 8):
+                with self.subTest(ensure_ascii=ensure_ascii, chunk_size=chunk_size):
+                    text, streamer = self.stream(document, chunk_size)
+                    self.assertEqual(text, value)
+                    self.assertTrue(streamer.found)
+
+    def test_missing_field(self):
+        text, streamer = self.stream('{"python_code": "x = 1"}', 3)
+        self.assertEqual(text, "")
+        self.assertFalse(streamer.found)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import asyncio
 import unittest
 
 
@@ -18,7 +19,7 @@ class TestPromptOrCode(unittest.TestCase):
         ]
         for text in valid_inputs:
             with self.subTest(text=text):
-                self.assertFalse(is_python_with_syntax_error(text))
+                self.assertFalse(asyncio.run(is_python_with_syntax_error(text)))
 
     def test_is_python_with_syntax_error_has_error(self):
         """Test invalid inputs that should not be considered plain text."""
@@ -29,7 +30,7 @@ class TestPromptOrCode(unittest.TestCase):
         ]
         for text in invalid_inputs:
             with self.subTest(text=text):
-                self.assertTrue(is_python_with_syntax_error(text), text)
+                self.assertTrue(asyncio.run(is_python_with_syntax_error(text)), text)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,18 @@
-import unittest, os
-from replgpt.replgpt import LLMEnhancedREPL
+import unittest, os, io, sys, asyncio, tempfile
+from unittest.mock import AsyncMock, patch
+from contextlib import redirect_stdout
+from replgpt.replgpt import LLMEnhancedREPL, StreamPrinter, DualStream, BufferPool, CodeBlockScanner, compile_snippet
+
+def streamed(*deltas, delay=0):
+    # Stand in for the streamed response of openai.ChatCompletion.acreate
+    async def chunks():
+        for delta in deltas:
+            await asyncio.sleep(delay)
+            yield {"choices": [{"delta": {"content": delta}}]}
+    return chunks()
+
+def interrupt():
+    raise KeyboardInterrupt
 
 class TestLLMEnhancedREPL(unittest.TestCase):
 
@@ -28,9 +41,507 @@ class TestLLMEnhancedREPL(unittest.TestCase):
             if os.path.exists(test_file_path):
                 os.remove(test_file_path)
 
+    def test_add_file_to_context_rereads_modified_file(self):
+        test_file_path = "tests/test_file.txt"
+        try:
+            with open(test_file_path, "w") as f:
+                f.write("first")
+            self.repl.add_file_to_context(test_file_path)
+
+            with open(test_file_path, "w") as f:
+                f.write("second version")
+            self.repl.add_file_to_context(test_file_path)
+            self.assertEqual(self.repl.file_context[test_file_path], "second version")
+        finally:
+            if os.path.exists(test_file_path):
+                os.remove(test_file_path)
+
+    def test_add_large_file_to_context_keeps_head_and_tail(self):
+        test_file_path = "tests/test_file.txt"
+        try:
+            with open(test_file_path, "w") as f:
+                f.write("a" * 10 + "b" * 10)
+            with patch.object(LLMEnhancedREPL, "_MAX_FILE_BYTES", 8):
+                self.repl.add_file_to_context(test_file_path)
+            self.assertEqual(self.repl.file_context[test_file_path], "aaaa\n<file truncated>\nbbbb")
+        finally:
+            if os.path.exists(test_file_path):
+                os.remove(test_file_path)
+
+    def test_file_contents_sent_once(self):
+        self.repl.file_context["a.py"] = "a = 1"
+        first = self.repl.build_user_messages("first")
+        self.assertEqual([m["content"] for m in first], ["[file] a.py\na = 1", "first"])
+
+        second = self.repl.build_user_messages("second")
+        self.assertEqual([m["content"] for m in second], ["second"])
+
+    def test_commands_sent_once(self):
+        with redirect_stdout(io.StringIO()):
+            self.repl.push("x = 1")
+            self.repl.push("print(x)")
+        first = self.repl.build_user_messages("first")
+        self.assertEqual(
+            [m["content"] for m in first],
+            ["[repl-exec]\n>>> x = 1\n", "[repl-exec]\n>>> print(x)\n1", "first"],
+        )
+
+        second = self.repl.build_user_messages("second")
+        self.assertEqual([m["content"] for m in second], ["second"])
+
+    def test_commands(self):
+        self.repl.push("/auto_eval never")
+        self.assertEqual(self.repl.auto_eval_strategy, "never")
+        self.repl.push("/auto_eval sometimes")
+        self.assertEqual(self.repl.auto_eval_strategy, "never")
+        self.repl.push("/auto_eval\tinfer")
+        self.assertEqual(self.repl.auto_eval_strategy, "infer")
+
+        self.repl.push("/toggle_json_mode")
+        self.assertTrue(self.repl.use_json_mode)
+
+    def test_execute_code_reuses_compiled_snippet(self):
+        snippet = "counter = counter + 1 if 'counter' in globals() else 1"
+        with redirect_stdout(io.StringIO()):
+            self.repl.execute_code(snippet)
+            self.repl.execute_code(snippet)
+        self.assertEqual(self.repl.locals["counter"], 2)
+        self.assertGreaterEqual(compile_snippet.cache_info().hits, 1)
+
+    def test_close_restores_openai_session(self):
+        import openai
+        previous = openai.aiosession.get(None)
+        self.repl.open_session()
+        self.assertIsNotNone(openai.aiosession.get(None))
+        self.repl.close()
+        self.assertIs(openai.aiosession.get(None), previous)
+
+    def test_interrupted_prompt_does_not_resume(self):
+        self.repl.open_session()
+        response = streamed("Setting a flag.\n", "```python\nINTERRUPTED = True\n```\n", delay=0.05)
+        self.repl._loop.call_later(0.02, interrupt)
+        with patch("openai.ChatCompletion.acreate", AsyncMock(return_value=response)), \
+                redirect_stdout(io.StringIO()):
+            with self.assertRaises(KeyboardInterrupt):
+                self.repl.handle_prompt("set a flag")
+            # Running the loop again mustn't pick the interrupted prompt back up
+            self.repl._loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertFalse("INTERRUPTED" in self.repl.locals)
+        self.assertNotEqual(self.repl.conversation_history[-1]["role"], "assistant")
+
+    def test_summarize_conversation(self):
+        summary = {"choices": [{"message": {"content": "Defined x."}}]}
+        messages = [{"role": "user", "content": f"message {i}"} for i in range(50)]
+        self.repl.conversation_history.extend(messages)
+
+        with patch("openai.ChatCompletion.acreate", AsyncMock(return_value=summary)):
+            asyncio.run(self.repl.summarize_conversation())
+
+        history = self.repl.conversation_history
+        self.assertIs(history[0], self.repl.system_message)
+        self.assertEqual(history[1]["content"], "Conversation summary so far:\nDefined x.")
+        self.assertEqual(history[2:], messages[-self.repl._MAX_KEPT_MESSAGES:])
+
+    def test_summarize_conversation_over_token_threshold(self):
+        summary = {"choices": [{"message": {"content": "Read a big file."}}]}
+        messages = [{"role": "user", "content": "word " * 100} for i in range(25)]
+        self.repl.conversation_history.extend(messages)
+
+        with patch.object(LLMEnhancedREPL, "_SUMMARIZE_TOKEN_THRESHOLD", 1000), \
+                patch("openai.ChatCompletion.acreate", AsyncMock(return_value=summary)):
+            asyncio.run(self.repl.summarize_conversation())
+
+        history = self.repl.conversation_history
+        self.assertEqual(history[1]["content"], "Conversation summary so far:\nRead a big file.")
+        self.assertEqual(history[2:], messages[-self.repl._MAX_KEPT_MESSAGES:])
+
+    def test_large_recent_file_does_not_summarize_every_prompt(self):
+        summary = {"choices": [{"message": {"content": "Talked about a.py."}}]}
+        self.repl.file_context["a.py"] = "word " * 2000
+
+        async def respond(**kwargs):
+            return streamed("Done.") if kwargs.get("stream") else summary
+        acreate = AsyncMock(side_effect=respond)
+        with patch.object(LLMEnhancedREPL, "_SUMMARIZE_TOKEN_THRESHOLD", 1000), \
+                patch("openai.ChatCompletion.acreate", acreate), redirect_stdout(io.StringIO()):
+            for i in range(30):
+                asyncio.run(self.repl.handle_standard_prompt(f"prompt {i}"))
+
+        summaries = [c for c in acreate.call_args_list if not c.kwargs.get("stream")]
+        self.assertLessEqual(len(summaries), 3)
+
+    def test_conversation_tokens_counts_each_message_once(self):
+        self.repl.conversation_history.append({"role": "user", "content": "hello"})
+        first = self.repl.conversation_tokens()
+        with patch("replgpt.tokens.token_len", return_value=1) as token_len:
+            self.assertEqual(self.repl.conversation_tokens(), first)
+            token_len.assert_not_called()
+
+            self.repl.conversation_history.append({"role": "user", "content": "again"})
+            self.assertEqual(self.repl.conversation_tokens(), first + 1)
+            token_len.assert_called_once_with("again")
+
+    def test_conversation_saved_and_resumed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.jsonl")
+            repl = LLMEnhancedREPL(session_path=path)
+            repl.file_context["a.py"] = "a = 1"
+            repl.conversation_history.extend(repl.build_user_messages("first"))
+            repl.save_conversation()
+            repl.conversation_history.append({"role": "assistant", "content": "answer"})
+            repl.save_conversation()
+            repl.close()
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+            with redirect_stdout(io.StringIO()):
+                resumed = LLMEnhancedREPL(session_path=path)
+            self.assertEqual(resumed.conversation_history, repl.conversation_history)
+            self.assertEqual(resumed.file_context, {"a.py": "a = 1"})
+            self.assertEqual([m["content"] for m in resumed.build_user_messages("second")], ["second"])
+
+            # Replacing the conversation rewrites the file
+            with redirect_stdout(io.StringIO()):
+                resumed.toggle_json_mode()
+            resumed.close()
+            with redirect_stdout(io.StringIO()):
+                json_mode = LLMEnhancedREPL(session_path=path)
+            self.assertTrue(json_mode.use_json_mode)
+            self.assertEqual(json_mode.conversation_history, [json_mode.system_message])
+            json_mode.close()
+
+    def test_session_file_is_private(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.jsonl")
+            repl = LLMEnhancedREPL(session_path=path)
+            repl.save_conversation()
+            repl.close()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_prompt_resembling_a_file_is_not_loaded_as_one(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.jsonl")
+            repl = LLMEnhancedREPL(session_path=path)
+            repl.conversation_history.extend(repl.build_user_messages("[file] notes.txt\nnot a file"))
+            repl.save_conversation()
+            repl.close()
+
+            with redirect_stdout(io.StringIO()):
+                resumed = LLMEnhancedREPL(session_path=path)
+            self.assertEqual(resumed.file_context, {})
+            self.assertEqual(resumed.conversation_history, repl.conversation_history)
+            resumed.close()
+
+    def test_invalid_session_file_not_reused(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.jsonl")
+            with open(path, "w") as f:
+                f.write('{"message": {"role": "user", "content": "no system message"}}\n')
+
+            output = io.StringIO()
+            with redirect_stdout(output):
+                repl = LLMEnhancedREPL(session_path=path)
+            self.assertIn("Error reading session file", output.getvalue())
+            self.assertEqual(repl.conversation_history, [repl.system_message])
+
+            repl.conversation_history.append({"role": "user", "content": "hi"})
+            repl.save_conversation()
+            repl.close()
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+    def test_file_summarized_away_is_sent_with_the_prompt(self):
+        summary = {"choices": [{"message": {"content": "Read a.py."}}]}
+        self.repl.file_context["a.py"] = "a = 1"
+        self.repl.conversation_history.extend(self.repl.build_user_messages("read a.py"))
+        self.repl.conversation_history.extend(
+            {"role": "user", "content": f"message {i}"} for i in range(50))
+
+        acreate = AsyncMock(side_effect=[summary, streamed("Done.")])
+        with patch("openai.ChatCompletion.acreate", acreate), redirect_stdout(io.StringIO()):
+            asyncio.run(self.repl.handle_standard_prompt("next"))
+
+        sent = acreate.call_args_list[1].kwargs["messages"]
+        self.assertIn("[file] a.py\na = 1", [m["content"] for m in sent])
+
     def tearDown(self):
         # Clean up if necessary after each test
+        self.repl.close()
         self.repl = None
 
+class TestInferAutoEval(unittest.TestCase):
+
+    def setUp(self):
+        self.repl = LLMEnhancedREPL()
+        self.repl.auto_eval_strategy = 'infer'
+
+    def prompt(self, deltas, is_safe):
+        output = io.StringIO()
+        with patch("openai.ChatCompletion.acreate", AsyncMock(return_value=deltas)), \
+                patch("replgpt.code_safety.is_safe_to_execute", is_safe), redirect_stdout(output):
+            asyncio.run(self.repl.handle_standard_prompt("set x"))
+        return output.getvalue()
+
+    def test_safe_code_executed(self):
+        output = self.prompt(streamed("```python\nx = 1\n```\n"), AsyncMock(return_value=True))
+        self.assertEqual(self.repl.locals["x"], 1)
+        self.assertIn("Code executed successfully.", output)
+
+    def test_unsafe_code_not_executed(self):
+        output = self.prompt(streamed("```python\nx = 1\n```\n"), AsyncMock(return_value=False))
+        self.assertNotIn("x", self.repl.locals)
+        self.assertIn("Generated code was not executed as it may have side effects.", output)
+
+    def test_unexpected_safety_response(self):
+        is_safe = AsyncMock(side_effect=ValueError("Expected a boolean 'allow' attribute."))
+        output = self.prompt(streamed("```python\nx = 1\n```\n"), is_safe)
+        self.assertNotIn("x", self.repl.locals)
+        self.assertIn("Unable to determine if generated code is safe to execute", output)
+
+    def test_safety_check_overlaps_stream(self):
+        stream_finished = []
+
+        async def deltas():
+            yield {"choices": [{"delta": {"content": "```python\nx = 1\n```\n"}}]}
+            await asyncio.sleep(0.05)
+            yield {"choices": [{"delta": {"content": "More explanation."}}]}
+            stream_finished.append(True)
+
+        async def is_safe(code_snippet):
+            self.assertEqual(stream_finished, [])
+            self.assertEqual(code_snippet, "x = 1\n")
+            return True
+        is_safe = AsyncMock(side_effect=is_safe)
+        self.prompt(deltas(), is_safe)
+        is_safe.assert_awaited_once()
+        self.assertEqual(self.repl.locals["x"], 1)
+
+    def test_safety_decisions_cached(self):
+        is_safe = AsyncMock(return_value=True)
+        with patch("replgpt.code_safety.is_safe_to_execute", is_safe):
+            self.assertTrue(asyncio.run(self.repl.is_safe_to_execute("x = 1")))
+            self.assertTrue(asyncio.run(self.repl.is_safe_to_execute("x = 1")))
+        is_safe.assert_awaited_once_with("x = 1")
+
+    def test_safety_cache_evicts_least_recently_used(self):
+        is_safe = AsyncMock(return_value=True)
+        with patch.object(LLMEnhancedREPL, "_SAFETY_CACHE_SIZE", 2), \
+                patch("replgpt.code_safety.is_safe_to_execute", is_safe):
+            for snippet in ["a = 1", "b = 2", "a = 1", "c = 3", "a = 1", "b = 2"]:
+                asyncio.run(self.repl.is_safe_to_execute(snippet))
+        # "a = 1" was used most recently when "c = 3" was added, so "b = 2" was evicted
+        self.assertEqual([c.args[0] for c in is_safe.await_args_list], ["a = 1", "b = 2", "c = 3", "b = 2"])
+        self.assertEqual(len(self.repl._safety_cache), 2)
+
+    def tearDown(self):
+        self.repl.close()
+
+class FakeCache:
+    # Dict backed stand in for diskcache.Cache
+    def __init__(self):
+        self.data = {}
+        self.expire = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, expire=None):
+        self.data[key] = value
+        self.expire[key] = expire
+
+    def close(self):
+        pass
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FakeCache()
+        self.repls = []
+
+    def new_repl(self, json_mode=False):
+        repl = LLMEnhancedREPL(response_cache=self.cache)
+        if json_mode:
+            with redirect_stdout(io.StringIO()):
+                repl.toggle_json_mode()
+        self.repls.append(repl)
+        return repl
+
+    def prompt(self, repl, user_input, acreate):
+        output = io.StringIO()
+        with patch("openai.ChatCompletion.acreate", acreate), redirect_stdout(output):
+            asyncio.run(repl._handle_prompt_async(user_input))
+        return output.getvalue()
+
+    def test_cache_key(self):
+        uncached = LLMEnhancedREPL()
+        self.repls.append(uncached)
+        self.assertIsNone(uncached.response_cache_key())
+        first, second = self.new_repl(), self.new_repl()
+        self.assertEqual(first.response_cache_key(), second.response_cache_key())
+        second.conversation_history.append({"role": "user", "content": "hi"})
+        self.assertNotEqual(first.response_cache_key(), second.response_cache_key())
+        self.assertNotEqual(first.response_cache_key(), self.new_repl(json_mode=True).response_cache_key())
+
+    def test_standard_response_replayed(self):
+        response = "Setting x.\n```python\nx = 1\n```\n"
+        acreate = AsyncMock(side_effect=lambda **kwargs: streamed(*response.splitlines(keepends=True)))
+
+        first, second = self.new_repl(), self.new_repl()
+        first_output = self.prompt(first, "set x", acreate)
+        second_output = self.prompt(second, "set x", acreate)
+
+        acreate.assert_called_once()
+        self.assertEqual(list(self.cache.data.values()), [response])
+        self.assertEqual(second_output, first_output)
+        self.assertEqual(second.locals["x"], 1)
+        self.assertEqual(second.conversation_history[-1], {"role": "assistant", "content": response})
+
+    def test_json_response_replayed(self):
+        response = '{"user_visible_response": "Setting x.", "python_code": "x = 1", "should_execute": true}'
+        acreate = AsyncMock(side_effect=lambda **kwargs: streamed(response[:20], response[20:]))
+
+        first, second = self.new_repl(json_mode=True), self.new_repl(json_mode=True)
+        first_output = self.prompt(first, "set x", acreate)
+        second_output = self.prompt(second, "set x", acreate)
+
+        acreate.assert_called_once()
+        self.assertEqual(second_output, first_output)
+        self.assertIn("Setting x.", second_output)
+        self.assertEqual(second.locals["x"], 1)
+
+    def test_unparsable_json_response_not_cached(self):
+        acreate = AsyncMock(side_effect=lambda **kwargs: streamed('{"user_visible_response": "cut off'))
+        repl = self.new_repl(json_mode=True)
+        output = self.prompt(repl, "set x", acreate)
+        self.assertIn("Error parsing JSON response", output)
+        self.assertEqual(self.cache.data, {})
+
+    def tearDown(self):
+        for repl in self.repls:
+            repl.close()
+
+class TestDualStream(unittest.TestCase):
+
+    def test_buffer_reused_after_release(self):
+        pool = BufferPool(max_size=1)
+        target = io.StringIO()
+        stream = DualStream(target, 100, pool=pool)
+        stream.write("first")
+        self.assertEqual(stream.get_value(), "first")
+        buffer = stream.buffer
+        stream.release()
+
+        # Writes after release still reach the target
+        stream.write("!")
+        self.assertEqual(target.getvalue(), "first!")
+
+        second = DualStream(target, 100, pool=pool)
+        self.assertIs(second.buffer, buffer)
+        self.assertEqual(second.get_value(), "")
+
+    def test_capture_is_bounded(self):
+        target = io.StringIO()
+        stream = DualStream(target, 10, pool=BufferPool())
+        stream.write("0123")
+        stream.write("4567")
+        self.assertFalse(stream.truncated)
+        self.assertEqual(stream.get_value(), "01234567")
+
+        stream.write("89" * 1000)
+        self.assertTrue(stream.truncated)
+        self.assertEqual(stream.get_value(), "01234\n<output truncated>\n98989")
+        self.assertEqual(len(target.getvalue()), 2008)
+
+    def test_capture_keeps_multibyte_characters(self):
+        target = io.StringIO()
+        stream = DualStream(target, 100, pool=BufferPool())
+        stream.write("héllo wörld")
+        self.assertEqual(stream.get_value(), "héllo wörld")
+
+    def test_truncation_keeps_multibyte_characters_whole(self):
+        target = io.StringIO()
+        stream = DualStream(target, 10, pool=BufferPool())
+        stream.write("é" * 20)
+        self.assertEqual(stream.get_value(), "éé\n<output truncated>\néé")
+
+        stream = DualStream(target, 12, pool=BufferPool())
+        stream.write("ab" + "日本" * 10)
+        self.assertEqual(stream.get_value(), "ab日\n<output truncated>\n日本")
+
+    def test_writes_bytes_to_binary_target(self):
+        raw = io.BytesIO()
+        target = io.TextIOWrapper(raw, encoding="utf-8")
+        target.write("before ")
+        stream = DualStream(target, 100, pool=BufferPool())
+        stream.write("héllo")
+        self.assertEqual(raw.getvalue().decode("utf-8"), "before héllo")
+        self.assertEqual(stream.get_value(), "héllo")
+
+    def test_flushes_complete_lines(self):
+        raw = io.BytesIO()
+        target = io.BufferedWriter(raw)
+        target.encoding = "utf-8"
+        wrapper = io.TextIOWrapper(target, encoding="utf-8")
+        stream = DualStream(wrapper, 100, pool=BufferPool())
+        stream.write("partial")
+        self.assertEqual(raw.getvalue(), b"")
+        stream.write(" line\n")
+        self.assertEqual(raw.getvalue(), b"partial line\n")
+        stream.write("rest")
+        stream.release()
+        self.assertEqual(raw.getvalue(), b"partial line\nrest")
+
+    def test_interleaves_output_and_errors(self):
+        out, err = io.StringIO(), io.StringIO()
+        stream = DualStream(out, 100, pool=BufferPool(), error_target=err)
+        with stream.capture():
+            print("one")
+            print("two", file=sys.stderr)
+            print("three")
+        self.assertEqual(stream.get_value(), "one\ntwo\nthree\n")
+        self.assertEqual(out.getvalue(), "one\nthree\n")
+        self.assertEqual(err.getvalue(), "two\n")
+
+class TestStreamPrinter(unittest.TestCase):
+
+    def test_coalesces_writes(self):
+        target = io.StringIO()
+        printer = StreamPrinter(target, max_chunks=3, max_delay=60)
+        printer.write("a")
+        printer.write("b")
+        self.assertEqual(target.getvalue(), "")
+        printer.write("c")
+        self.assertEqual(target.getvalue(), "abc")
+        printer.write("d")
+        printer.flush()
+        self.assertEqual(target.getvalue(), "abcd")
+
+    def test_writes_complete_lines(self):
+        target = io.StringIO()
+        printer = StreamPrinter(target, max_chunks=10, max_delay=60)
+        printer.write("a")
+        printer.write("b\nc")
+        self.assertEqual(target.getvalue(), "ab\nc")
+
+class TestCodeBlockScanner(unittest.TestCase):
+
+    def scan(self, deltas):
+        scanner = CodeBlockScanner()
+        for delta in deltas:
+            scanner.feed(delta)
+        return scanner.code
+
+    def test_fences_split_across_deltas(self):
+        deltas = ["Here:\n``", "`pyth", "on\ndef f(x):\n", "    return x\n`", "``\nDone."]
+        self.assertEqual(self.scan(deltas), "def f(x):\n    return x\n")
+
+    def test_first_block_only(self):
+        deltas = ["```python\na = 1\n```\n", "```python\nb = 2\n```"]
+        self.assertEqual(self.scan(deltas), "a = 1\n")
+
+    def test_no_code(self):
+        self.assertIsNone(self.scan(["```bash\nls\n```", " and some text"]))
+        self.assertIsNone(self.scan(["```python\nnever closed"]))
+
 if __name__ == '__main__':
     unittest.main()
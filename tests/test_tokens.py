@@ -0,0 +1,24 @@
+import unittest
+
+from replgpt.tokens import token_len, truncate_middle
+
+class TestTokens(unittest.TestCase):
+
+    def test_token_len(self):
+        self.assertEqual(token_len(""), 0)
+        self.assertGreater(token_len("print('Hello, world!')"), 0)
+
+    def test_truncate_middle_short_text(self):
+        text = "x = 1"
+        self.assertEqual(truncate_middle(text, 100), text)
+
+    def test_truncate_middle_long_text(self):
+        text = "start " + "word " * 1000 + "end"
+        truncated = truncate_middle(text, 100)
+        self.assertIn("\n<output truncated>\n", truncated)
+        self.assertTrue(truncated.startswith("start "))
+        self.assertTrue(truncated.endswith("end"))
+        self.assertLess(len(truncated), len(text))
+
+if __name__ == '__main__':
+    unittest.main()